@@ -6,86 +6,54 @@ Uses python-telegram-bot 13.15 (stable)
 
 import os
 import sys
-import tempfile
+import atexit
+import gc
+import hashlib
 import logging
-from datetime import datetime
-from pathlib import Path
+import queue
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from urllib.request import urlopen
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Logging is configured in start_logging(), called from main()
 logger = logging.getLogger(__name__)
 
 # Import Telegram bot
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Updater,
     CommandHandler,
     MessageHandler,
     Filters,
-    CallbackQueryHandler,
-    ConversationHandler
+    CallbackQueryHandler
 )
 
 # Import PDF processor
-try:
-    from pdf_processor import PDFProcessor
-    pdf_processor = PDFProcessor()
-except ImportError:
-    # Simple fallback PDF processor
-    class PDFProcessor:
-        def merge_pdfs(self, input_paths, output_path):
-            from PyPDF2 import PdfMerger
-            merger = PdfMerger()
-            for pdf in input_paths:
-                merger.append(pdf)
-            merger.write(output_path)
-            merger.close()
-        
-        def add_watermark(self, input_path, output_path, text, position='center', opacity=0.3):
-            from PyPDF2 import PdfReader, PdfWriter
-            from reportlab.pdfgen import canvas
-            from reportlab.lib.pagesizes import A4
-            from io import BytesIO
-            
-            # Create watermark
-            packet = BytesIO()
-            can = canvas.Canvas(packet, pagesize=A4)
-            can.setFillAlpha(opacity)
-            can.setFont("Helvetica-Bold", 36)
-            can.setFillColorRGB(0.5, 0.5, 0.5)
-            
-            # Position
-            if position == 'center':
-                can.drawCentredString(300, 400, text)
-            elif position == 'top':
-                can.drawCentredString(300, 700, text)
-            elif position == 'bottom':
-                can.drawCentredString(300, 100, text)
-            elif position == 'diagonal':
-                can.rotate(45)
-                can.drawCentredString(300, 300, text)
-            
-            can.save()
-            packet.seek(0)
-            
-            # Apply watermark
-            reader = PdfReader(input_path)
-            writer = PdfWriter()
-            
-            for page in reader.pages:
-                page.merge_page(PdfReader(packet).pages[0])
-                writer.add_page(page)
-            
-            with open(output_path, 'wb') as output_file:
-                writer.write(output_file)
-    
-    pdf_processor = PDFProcessor()
+from pdf_processor import PDFProcessor
+pdf_processor = PDFProcessor()
+
+# Scratch space for downloaded and generated PDFs (created in main())
+from utils.file_cleaner import TempFileManager
+temp_manager = None
+
+# Upload checks (20MB size limit; PDF_DOCUMENT filters the type)
+from utils.validators import FileValidator
+file_validator = FileValidator()
+
+# Temp files older than this are removed by the sweeper thread
+TEMP_FILE_EXPIRY_MINUTES = int(os.getenv('TEMP_FILE_EXPIRY_MINUTES', '60'))
 
 # Load environment variable
 TOKEN = os.getenv('TELEGRAM_TOKEN')
+# Public URL of the service (set by Render); enables webhook mode
+WEBHOOK_BASE_URL = os.getenv('RENDER_EXTERNAL_URL', '').rstrip('/')
+PORT = int(os.getenv('PORT', '8443'))
+# Only the update types we handle are delivered
+ALLOWED_UPDATES = ['message', 'callback_query']
 if not TOKEN:
     logger.error("TELEGRAM_TOKEN environment variable not set!")
     print("ERROR: TELEGRAM_TOKEN not set!")
@@ -93,7 +61,6 @@ if not TOKEN:
     sys.exit(1)
 
 # Bot states
-STATE_WAITING = 0
 STATE_UPLOADING_MERGE = 1
 STATE_UPLOADING_RENAME = 2
 STATE_UPLOADING_WATERMARK = 3
@@ -101,57 +68,282 @@ STATE_WAITING_FILENAME = 4
 STATE_WAITING_WATERMARK_TEXT = 5
 STATE_WAITING_WATERMARK_POSITION = 6
 
-# User session storage
-user_sessions = {}
+# User session storage, least recently used first. Idle sessions expire
+# and the total is capped, so abandoned flows don't pile up in memory.
+SESSION_TTL = int(os.getenv('SESSION_TTL_MINUTES', '60')) * 60
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', '10000'))
+user_sessions = OrderedDict()
 
-def get_user_session(chat_id):
-    """Get or create user session"""
-    if chat_id not in user_sessions:
-        user_sessions[chat_id] = {
-            'state': STATE_WAITING,
-            'data': {}
-        }
-    return user_sessions[chat_id]
-
-def clear_user_session(chat_id):
-    """Clear user session"""
-    if chat_id in user_sessions:
-        del user_sessions[chat_id]
-
-def get_main_menu():
-    """Create main menu"""
-    keyboard = [
-        [
-            InlineKeyboardButton("📄 Merge PDFs", callback_data='merge'),
-            InlineKeyboardButton("✏️ Rename PDF", callback_data='rename'),
-        ],
-        [
-            InlineKeyboardButton("💧 Add Watermark", callback_data='watermark'),
-            InlineKeyboardButton("❓ Help", callback_data='help'),
-        ],
-        [
-            InlineKeyboardButton("🚫 Cancel", callback_data='cancel'),
-        ]
+# Background PDF jobs (merge/watermark/rename) so the dispatcher keeps handling updates
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_QUEUE_LIMIT = int(os.getenv('JOB_QUEUE_LIMIT', '16'))
+job_executor = None
+job_slots = threading.BoundedSemaphore(JOB_QUEUE_LIMIT)
+
+# Document downloads get their own threads: merge jobs wait on them, so
+# they must never queue behind those jobs
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+download_executor = None
+
+# CPU-bound PDF work runs in worker processes so it never holds the GIL
+# of the bot process. forkserver avoids forking a process that already
+# runs the dispatcher and job threads. Workers are recycled after a number
+# of jobs so memory held on to by pypdf/reportlab is returned to the OS.
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', '0')) or os.cpu_count() or 1
+PDF_TASKS_PER_WORKER = int(os.getenv('PDF_TASKS_PER_WORKER', '50'))
+pdf_pool = None
+
+# The pool's worker processes import this module again (as __mp_main__),
+# so the temp dir, threads and pools above are only created by main()
+
+def start_logging():
+    """Route log records through a queue written by a listener thread,
+    so handlers and jobs never block on log output"""
+    log_queue = queue.SimpleQueue()
+    log_output = logging.StreamHandler()
+    log_output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_listener = QueueListener(log_queue, log_output)
+    # The listener's handler does the formatting; the queue side must only
+    # pass the message through, or lines are formatted twice
+    log_handler = QueueHandler(log_queue)
+    log_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(
+        handlers=[log_handler],
+        level=logging.INFO
+    )
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+def start_workers():
+    """Create the temp dir manager, job threads and PDF worker pool"""
+    global temp_manager, job_executor, download_executor, pdf_pool
+    temp_manager = TempFileManager()
+    job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='pdf_job')
+    download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='download')
+    pdf_pool = ProcessPoolExecutor(
+        max_workers=PDF_WORKERS,
+        mp_context=multiprocessing.get_context('forkserver'),
+        max_tasks_per_child=PDF_TASKS_PER_WORKER
+    )
+
+def run_pdf_task(func, *args):
+    """Run a PDF processor call in the worker pool and wait for it"""
+    return pdf_pool.submit(func, *args).result()
+
+def open_output(path):
+    """Open a generated PDF for upload, refusing to send an empty file"""
+    if os.path.getsize(path) == 0:
+        raise RuntimeError("Generated PDF is empty")
+    return open(path, 'rb')
+
+def submit_job(chat_id, bot, job, *args):
+    """Queue a PDF job and return immediately; False if the queue is full"""
+    if not job_slots.acquire(blocking=False):
+        bot.send_message(chat_id, "⏳ Bot is busy right now. Please try again in a minute.")
+        return False
+    
+    def run():
+        try:
+            job(chat_id, bot, *args)
+        finally:
+            job_slots.release()
+    
+    job_executor.submit(run)
+    return True
+
+def find_user_session(chat_id):
+    """Return the user's live session, or None if absent or expired"""
+    session = user_sessions.get(chat_id)
+    if session is None:
+        return None
+    
+    now = time.monotonic()
+    if now - session['touched'] > SESSION_TTL:
+        clear_user_session(chat_id)
+        return None
+    
+    session['touched'] = now
+    user_sessions.move_to_end(chat_id)
+    return session
+
+def new_user_session(chat_id, state, data):
+    """Replace the user's session; its files live in a private temp dir"""
+    clear_user_session(chat_id)
+    session = user_sessions[chat_id] = {
+        'state': state,
+        'data': data,
+        'tmpdir': temp_manager.create_session_dir(),
+        'touched': time.monotonic()
+    }
+    expire_user_sessions()
+    return session
+
+def expire_user_sessions():
+    """Drop idle sessions, and the least recently used ones over the cap"""
+    now = time.monotonic()
+    while user_sessions:
+        chat_id, session = next(iter(user_sessions.items()))
+        if len(user_sessions) <= MAX_SESSIONS and now - session['touched'] <= SESSION_TTL:
+            break
+        clear_user_session(chat_id)
+
+def clear_user_session(chat_id, keep_files=False):
+    """Clear user session and delete its files.
+    
+    keep_files=True hands the temp dir over to a background job, which
+    discards it when done.
+    """
+    session = user_sessions.pop(chat_id, None)
+    if session is not None and not keep_files:
+        temp_manager.discard(session['tmpdir'])
+
+# Telegram file downloads are streamed to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60
+# Read timeout for send_document; PTB's 5s default is too short to get a
+# reply for a 20MB upload
+UPLOAD_TIMEOUT = int(os.getenv('UPLOAD_TIMEOUT', '120'))
+PDF_MAGIC = b'%PDF-'
+
+# Guards file_info_cache and upload_cache (used from the download threads)
+cache_lock = threading.Lock()
+
+# getFile links stay valid for at least an hour; reuse them for repeat uploads
+FILE_INFO_TTL = 50 * 60
+FILE_INFO_CACHE_SIZE = 256
+file_info_cache = OrderedDict()
+
+def get_file_info(bot, document):
+    """Resolve a document's download link, reusing recent getFile results"""
+    key = document.file_unique_id
+    with cache_lock:
+        cached = file_info_cache.get(key)
+        if cached and time.monotonic() - cached[0] < FILE_INFO_TTL:
+            file_info_cache.move_to_end(key)
+            return cached[1]
+    
+    file = bot.get_file(document.file_id)
+    with cache_lock:
+        file_info_cache[key] = (time.monotonic(), file)
+        if len(file_info_cache) > FILE_INFO_CACHE_SIZE:
+            file_info_cache.popitem(last=False)
+    return file
+
+def download_pdf(file, dest_dir):
+    """Stream a Telegram file into a temp file without buffering it in RAM.
+    
+    Returns (path, content digest), or (None, None) without touching the
+    disk if the data is not a PDF.
+    """
+    with urlopen(file.file_path, timeout=DOWNLOAD_TIMEOUT) as response:
+        # The PDF header must appear within the first 1024 bytes
+        head = response.read(DOWNLOAD_CHUNK_SIZE)
+        if PDF_MAGIC not in head[:1024]:
+            return None, None
+        
+        digest = hashlib.blake2b(head, digest_size=16)
+        with temp_manager.create_temp_file(dir=dest_dir) as f:
+            temp_path = f.name
+            try:
+                f.write(head)
+                for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    digest.update(chunk)
+            except Exception:
+                f.close()
+                os.unlink(temp_path)
+                raise
+    return temp_path, digest.digest()
+
+# Recently downloaded documents by file_unique_id. The cache keeps its own
+# hard link to each file so sessions can delete theirs independently; the
+# sweeper expires cached links like any other temp file. The links may live
+# on tmpfs (RAM), so the cache is capped by total size as well as count.
+UPLOAD_CACHE_SIZE = 32
+UPLOAD_CACHE_BYTES = int(os.getenv('UPLOAD_CACHE_MB', '64')) * 1024 * 1024
+upload_cache = OrderedDict()
+upload_cache_bytes = 0
+
+def drop_cached_upload(key):
+    """Forget a cached document and discard its link (caller holds cache_lock)"""
+    global upload_cache_bytes
+    cached_path, _, size = upload_cache.pop(key)
+    upload_cache_bytes -= size
+    temp_manager.discard(cached_path)
+
+def fetch_document(bot, document, dest_dir):
+    """Get a private copy of a document in dest_dir, downloading it only once.
+    
+    Returns (path, content digest), or (None, None) if it is not a PDF.
+    """
+    global upload_cache_bytes
+    key = document.file_unique_id
+    with cache_lock:
+        cached = upload_cache.get(key)
+        if cached:
+            cached_path, digest, _ = cached
+            try:
+                temp_path = temp_manager.link_copy(cached_path, dir=dest_dir)
+            except FileNotFoundError:
+                drop_cached_upload(key)
+            else:
+                upload_cache.move_to_end(key)
+                return temp_path, digest
+    
+    temp_path, digest = download_pdf(get_file_info(bot, document), dest_dir)
+    if temp_path is None:
+        return None, None
+    
+    size = os.path.getsize(temp_path)
+    if size > UPLOAD_CACHE_BYTES:
+        return temp_path, digest
+    
+    cache_path = temp_manager.link_copy(temp_path)
+    with cache_lock:
+        # A concurrent miss for the same document may have cached it already
+        if key in upload_cache:
+            drop_cached_upload(key)
+        upload_cache[key] = (cache_path, digest, size)
+        upload_cache_bytes += size
+        while len(upload_cache) > UPLOAD_CACHE_SIZE or upload_cache_bytes > UPLOAD_CACHE_BYTES:
+            drop_cached_upload(next(iter(upload_cache)))
+    return temp_path, digest
+
+# Static keyboards, built once at import
+MAIN_MENU = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📄 Merge PDFs", callback_data='merge'),
+        InlineKeyboardButton("✏️ Rename PDF", callback_data='rename'),
+    ],
+    [
+        InlineKeyboardButton("💧 Add Watermark", callback_data='watermark'),
+        InlineKeyboardButton("❓ Help", callback_data='help'),
+    ],
+    [
+        InlineKeyboardButton("🚫 Cancel", callback_data='cancel'),
     ]
-    return InlineKeyboardMarkup(keyboard)
-
-def get_watermark_position_menu():
-    """Create watermark position menu"""
-    keyboard = [
-        [
-            InlineKeyboardButton("Center", callback_data='pos_center'),
-            InlineKeyboardButton("Top", callback_data='pos_top'),
-        ],
-        [
-            InlineKeyboardButton("Bottom", callback_data='pos_bottom'),
-            InlineKeyboardButton("Diagonal", callback_data='pos_diagonal'),
-        ]
+])
+
+WATERMARK_POSITION_MENU = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Center", callback_data='pos_center'),
+        InlineKeyboardButton("Top", callback_data='pos_top'),
+    ],
+    [
+        InlineKeyboardButton("Bottom", callback_data='pos_bottom'),
+        InlineKeyboardButton("Diagonal", callback_data='pos_diagonal'),
     ]
-    return InlineKeyboardMarkup(keyboard)
+])
 
-def start(update, context):
-    """Handle /start command"""
-    welcome_text = """
+# Shown after each PDF added to a merge
+MERGE_MENU = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("➕ Add more", callback_data='merge_more'),
+        InlineKeyboardButton("✅ Merge now", callback_data='merge_now'),
+    ]
+])
+
+WELCOME_TEXT = """
 🤖 *PDF Utility Bot*
 
 I can help you with:
@@ -166,26 +358,15 @@ I can help you with:
 
 ⚠️ *Limits:* Max 20MB per file, PDF only
 """
-    
-    update.message.reply_text(
-        welcome_text,
-        parse_mode='Markdown',
-        reply_markup=get_main_menu()
-    )
-    
-    clear_user_session(update.effective_chat.id)
-    return STATE_WAITING
 
-def help_command(update, context):
-    """Handle /help command"""
-    help_text = """
+HELP_TEXT = """
 📚 *Commands:*
 /start - Show main menu
 /help - Show help
 /cancel - Cancel operation
 
 🔧 *Features:*
-1. *Merge PDFs*: Upload multiple PDFs to merge
+1. *Merge PDFs*: Upload PDFs, then tap Merge now
 2. *Rename PDF*: Upload PDF and provide new name
 3. *Add Watermark*: Upload PDF, add text watermark
 
@@ -194,277 +375,312 @@ def help_command(update, context):
 • Max 20MB per file
 • Files deleted after processing
 """
+
+# Ready-made reply arguments for the static messages
+WELCOME_MESSAGE = {'text': WELCOME_TEXT, 'parse_mode': 'Markdown', 'reply_markup': MAIN_MENU}
+HELP_MESSAGE = {'text': HELP_TEXT, 'parse_mode': 'Markdown'}
+
+def start(update, context):
+    """Handle /start command"""
+    update.message.reply_text(**WELCOME_MESSAGE)
     
-    update.message.reply_text(help_text, parse_mode='Markdown')
-    return STATE_WAITING
+    clear_user_session(update.effective_chat.id)
+
+def help_command(update, context):
+    """Handle /help command"""
+    update.effective_message.reply_text(**HELP_MESSAGE)
 
 def cancel(update, context):
     """Handle /cancel command"""
     clear_user_session(update.effective_chat.id)
-    update.message.reply_text(
+    update.effective_message.reply_text(
         "✅ Operation cancelled.",
-        reply_markup=get_main_menu()
+        reply_markup=MAIN_MENU
     )
-    return STATE_WAITING
 
-def button_handler(update, context):
-    """Handle button callbacks"""
-    query = update.callback_query
-    query.answer()
-    
+def start_merge(update, context):
+    """Start merge flow"""
+    new_user_session(update.effective_chat.id, STATE_UPLOADING_MERGE, {'files': []})
+    update.callback_query.edit_message_text(
+        text="📄 *Merge PDFs*\n\nSend me PDF files one by one, then tap Merge now. I'll merge them in order.\n\nSend first PDF now...",
+        parse_mode='Markdown'
+    )
+
+def start_rename(update, context):
+    """Start rename flow"""
+    new_user_session(update.effective_chat.id, STATE_UPLOADING_RENAME, {})
+    update.callback_query.edit_message_text(
+        text="✏️ *Rename PDF*\n\nSend me the PDF file you want to rename.",
+        parse_mode='Markdown'
+    )
+
+def start_watermark(update, context):
+    """Start watermark flow"""
+    new_user_session(update.effective_chat.id, STATE_UPLOADING_WATERMARK, {})
+    update.callback_query.edit_message_text(
+        text="💧 *Add Watermark*\n\nSend me the PDF file you want to watermark.",
+        parse_mode='Markdown'
+    )
+
+def merge_more(update, context):
+    """Keep collecting PDFs for the merge"""
+    update.callback_query.edit_message_text("📄 Send the next PDF...")
+
+def merge_now(update, context):
+    """Merge all PDFs uploaded so far"""
     chat_id = update.effective_chat.id
     
-    if query.data == 'merge':
-        user_sessions[chat_id] = {
-            'state': STATE_UPLOADING_MERGE,
-            'data': {'files': []}
-        }
-        query.edit_message_text(
-            text="📄 *Merge PDFs*\n\nSend me PDF files one by one. I'll merge them in order.\n\nSend first PDF now...",
-            parse_mode='Markdown'
-        )
-        return STATE_UPLOADING_MERGE
+    session = find_user_session(chat_id)
+    if session is None or session['state'] != STATE_UPLOADING_MERGE:
+        return
     
-    elif query.data == 'rename':
-        user_sessions[chat_id] = {
-            'state': STATE_UPLOADING_RENAME,
-            'data': {}
-        }
-        query.edit_message_text(
-            text="✏️ *Rename PDF*\n\nSend me the PDF file you want to rename.",
-            parse_mode='Markdown'
-        )
-        return STATE_UPLOADING_RENAME
+    files = session['data']['files']
+    if len(files) < 2:
+        update.effective_message.reply_text("Need at least 2 PDFs to merge")
+        return
     
-    elif query.data == 'watermark':
-        user_sessions[chat_id] = {
-            'state': STATE_UPLOADING_WATERMARK,
-            'data': {}
-        }
-        query.edit_message_text(
-            text="💧 *Add Watermark*\n\nSend me the PDF file you want to watermark.",
-            parse_mode='Markdown'
-        )
-        return STATE_UPLOADING_WATERMARK
-    
-    elif query.data == 'help':
-        help_command(update, context)
-        return STATE_WAITING
-    
-    elif query.data == 'cancel':
-        cancel(update, context)
-        return STATE_WAITING
+    # All files go to qpdf in one pass, in the background
+    if submit_job(chat_id, context.bot, process_merge, session['tmpdir'], files):
+        clear_user_session(chat_id, keep_files=True)
+
+def choose_watermark_position(update, context):
+    """Handle watermark position buttons"""
+    position = update.callback_query.data[4:]
+    chat_id = update.effective_chat.id
     
-    elif query.data.startswith('pos_'):
-        position = query.data.replace('pos_', '')
-        chat_id = update.effective_chat.id
-        
-        if chat_id in user_sessions:
-            user_sessions[chat_id]['data']['position'] = position
-            
-            # Process watermark
-            process_watermark(chat_id, context.bot)
+    session = find_user_session(chat_id)
+    if session and session['state'] == STATE_WAITING_WATERMARK_POSITION:
+        data = session['data']
+        data['position'] = position
         
-        return STATE_WAITING
+        # Process watermark in the background
+        if submit_job(chat_id, context.bot, process_watermark, session['tmpdir'], data):
+            clear_user_session(chat_id, keep_files=True)
+
+# Callback data -> handler
+CALLBACK_HANDLERS = {
+    'merge': start_merge,
+    'rename': start_rename,
+    'watermark': start_watermark,
+    'merge_more': merge_more,
+    'merge_now': merge_now,
+    'help': help_command,
+    'cancel': cancel,
+}
+
+# Buttons that carry a value, keyed by their 4-character prefix
+CALLBACK_PREFIX_HANDLERS = {
+    'pos_': choose_watermark_position,
+}
+
+def button_handler(update, context):
+    """Handle button callbacks"""
+    query = update.callback_query
+    query.answer()
     
-    return STATE_WAITING
+    handler = CALLBACK_HANDLERS.get(query.data) or CALLBACK_PREFIX_HANDLERS.get(query.data[:4])
+    if handler is not None:
+        handler(update, context)
+
+def reject_document(update, context):
+    """Handle uploads that are not PDFs"""
+    update.message.reply_text("❌ Please send a PDF file only.")
 
 def handle_document(update, context):
-    """Handle uploaded PDF files"""
+    """Handle uploaded PDF files (type already checked by the handler filter)"""
     chat_id = update.effective_chat.id
     document = update.message.document
     
-    # Check if PDF
-    if not document.file_name.lower().endswith('.pdf'):
-        update.message.reply_text("❌ Please send a PDF file only.")
-        return STATE_WAITING
-    
     # Check size (20MB max)
-    if document.file_size > 20 * 1024 * 1024:
+    if not file_validator.is_valid_size(document.file_size or 0):
         update.message.reply_text("❌ File too large. Max 20MB.")
-        return STATE_WAITING
+        return
     
-    # Download file
-    update.message.reply_text("📥 Downloading...")
+    # Handle based on state
+    session = find_user_session(chat_id)
+    if session is None:
+        update.message.reply_text("Please use /start first")
+        return
     
-    try:
-        file = context.bot.get_file(document.file_id)
-        downloaded = file.download_as_bytearray()
-        
-        # Save temp file
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
-            f.write(downloaded)
-            temp_path = f.name
-        
-        # Handle based on state
-        if chat_id not in user_sessions:
-            update.message.reply_text("Please use /start first")
-            os.unlink(temp_path)
-            return STATE_WAITING
-        
-        state = user_sessions[chat_id]['state']
-        
-        if state == STATE_UPLOADING_MERGE:
-            return handle_merge_doc(update, context, chat_id, temp_path, document.file_name)
-        
-        elif state == STATE_UPLOADING_RENAME:
-            user_sessions[chat_id]['data']['file_path'] = temp_path
-            user_sessions[chat_id]['state'] = STATE_WAITING_FILENAME
-            update.message.reply_text("✅ PDF received! Now send me the new filename (without .pdf):")
-            return STATE_WAITING_FILENAME
-        
-        elif state == STATE_UPLOADING_WATERMARK:
-            user_sessions[chat_id]['data']['file_path'] = temp_path
-            user_sessions[chat_id]['state'] = STATE_WAITING_WATERMARK_TEXT
-            update.message.reply_text("✅ PDF received! Now send me the watermark text:")
-            return STATE_WAITING_WATERMARK_TEXT
-        
-        else:
-            update.message.reply_text("Please select an option first", reply_markup=get_main_menu())
-            os.unlink(temp_path)
-            return STATE_WAITING
+    handler = DOCUMENT_HANDLERS.get(session['state'])
+    if handler is None:
+        update.message.reply_text("Please select an option first", reply_markup=MAIN_MENU)
+        return
     
+    # Download file into the session's temp dir in the background
+    update.message.reply_text("📥 Downloading...")
+    download = download_executor.submit(fetch_document, context.bot, document, session['tmpdir'])
+    handler(update, context, session, download, document.file_name)
+
+def wait_for_download(update, download):
+    """Wait for a queued download; return its path, or None after telling the user why not"""
+    try:
+        temp_path, digest = download.result()
     except Exception as e:
-        logger.error(f"Error: {e}")
+        logger.error("Error: %s", e)
         update.message.reply_text(f"❌ Error: {str(e)[:100]}")
-        return STATE_WAITING
+        return None
+    
+    if temp_path is None:
+        update.message.reply_text("❌ This file is not a valid PDF.")
+    return temp_path
 
-def handle_merge_doc(update, context, chat_id, file_path, file_name):
+def handle_merge_doc(update, context, session, download, file_name):
     """Handle merge document"""
-    user_sessions[chat_id]['data']['files'].append(file_path)
-    file_count = len(user_sessions[chat_id]['data']['files'])
+    # Don't wait for the download; back-to-back uploads are fetched in
+    # parallel and the merge job collects them
+    files = session['data']['files']
+    files.append((download, file_name))
     
     update.message.reply_text(
-        f"✅ Added: {file_name}\nTotal files: {file_count}\n\nSend another PDF or wait for merge..."
+        f"✅ Added: {file_name}\nTotal files: {len(files)}\n\nSend another PDF or tap Merge now.",
+        reply_markup=MERGE_MENU
     )
-    
-    # Auto-merge after 2 files
-    if file_count >= 2:
-        process_merge(chat_id, context.bot)
-    
-    return STATE_UPLOADING_MERGE
 
-def process_merge(chat_id, bot):
-    """Process merge operation"""
+def handle_rename_doc(update, context, session, download, file_name):
+    """Handle rename document"""
+    file_path = wait_for_download(update, download)
+    if file_path is None:
+        return
+    
+    session['data']['file_path'] = file_path
+    session['state'] = STATE_WAITING_FILENAME
+    update.message.reply_text("✅ PDF received! Now send me the new filename (without .pdf):")
+
+def handle_watermark_doc(update, context, session, download, file_name):
+    """Handle watermark document"""
+    file_path = wait_for_download(update, download)
+    if file_path is None:
+        return
+    
+    session['data']['file_path'] = file_path
+    session['state'] = STATE_WAITING_WATERMARK_TEXT
+    update.message.reply_text("✅ PDF received! Now send me the watermark text:")
+
+def collect_merge_files(chat_id, bot, files):
+    """Wait for the queued merge downloads and return their paths in order"""
+    paths = []
+    digests = {}
+    for download, file_name in files:
+        file_path, digest = download.result()
+        if file_path is None:
+            bot.send_message(chat_id, f"⚠️ Skipped {file_name}: not a valid PDF")
+            continue
+        
+        # The same content uploaded twice is merged twice but stored once
+        if digest in digests:
+            temp_manager.discard(file_path)
+            file_path = digests[digest]
+        else:
+            digests[digest] = file_path
+        paths.append(file_path)
+    return paths
+
+def process_merge(chat_id, bot, tmpdir, files):
+    """Process merge operation (runs on the job executor)"""
     try:
-        files = user_sessions[chat_id]['data']['files']
-        
-        if len(files) < 2:
+        paths = collect_merge_files(chat_id, bot, files)
+        if len(paths) < 2:
             bot.send_message(chat_id, "Need at least 2 PDFs to merge")
             return
         
         bot.send_message(chat_id, "🔄 Merging PDFs...")
         
-        # Create output file
-        with tempfile.NamedTemporaryFile(suffix='_merged.pdf', delete=False) as f:
-            output_path = f.name
-        
-        # Merge
-        pdf_processor.merge_pdfs(files, output_path)
+        # Merge into a fresh path in the session dir (removed with it); the
+        # writers replace the output by rename, so open it only afterwards
+        output_path = os.path.join(tmpdir, 'merged_output.pdf')
+        run_pdf_task(pdf_processor.merge_pdfs, paths, output_path)
         
-        # Send result
-        with open(output_path, 'rb') as file:
+        with open_output(output_path) as output_file:
             bot.send_document(
                 chat_id=chat_id,
-                document=file,
+                document=output_file,
                 caption="✅ Merged successfully!",
-                filename="merged.pdf"
+                filename="merged.pdf",
+                timeout=UPLOAD_TIMEOUT
             )
         
-        # Cleanup
-        for f in files:
-            try:
-                os.unlink(f)
-            except:
-                pass
-        os.unlink(output_path)
-        
-        # Clear session
-        clear_user_session(chat_id)
-        bot.send_message(chat_id, "✅ Done! What next?", reply_markup=get_main_menu())
+        bot.send_message(chat_id, "✅ Done! What next?", reply_markup=MAIN_MENU)
     
     except Exception as e:
-        logger.error(f"Merge error: {e}")
+        logger.error("Merge error: %s", e)
         bot.send_message(chat_id, f"❌ Merge failed: {str(e)[:100]}")
+    
+    finally:
+        temp_manager.discard(tmpdir)
 
 def handle_text(update, context):
     """Handle text messages"""
     chat_id = update.effective_chat.id
     text = update.message.text.strip()
     
-    if chat_id not in user_sessions:
-        update.message.reply_text("Please use /start first", reply_markup=get_main_menu())
-        return STATE_WAITING
-    
-    state = user_sessions[chat_id]['state']
+    session = find_user_session(chat_id)
+    if session is None:
+        update.message.reply_text("Please use /start first", reply_markup=MAIN_MENU)
+        return
     
-    if state == STATE_WAITING_FILENAME:
-        return handle_rename(update, context, chat_id, text)
+    handler = TEXT_HANDLERS.get(session['state'])
+    if handler is None:
+        update.message.reply_text("Please select an option", reply_markup=MAIN_MENU)
+        return
     
-    elif state == STATE_WAITING_WATERMARK_TEXT:
-        user_sessions[chat_id]['data']['watermark_text'] = text
-        user_sessions[chat_id]['state'] = STATE_WAITING_WATERMARK_POSITION
-        update.message.reply_text(
-            f"✅ Text: {text[:50]}\n\nChoose position:",
-            reply_markup=get_watermark_position_menu()
-        )
-        return STATE_WAITING_WATERMARK_POSITION
-    
-    else:
-        update.message.reply_text("Please select an option", reply_markup=get_main_menu())
-        return STATE_WAITING
+    handler(update, context, session, text)
 
-def handle_rename(update, context, chat_id, new_name):
+def handle_watermark_text(update, context, session, text):
+    """Handle watermark text"""
+    session['data']['watermark_text'] = text
+    session['state'] = STATE_WAITING_WATERMARK_POSITION
+    update.message.reply_text(
+        f"✅ Text: {text[:50]}\n\nChoose position:",
+        reply_markup=WATERMARK_POSITION_MENU
+    )
+
+def handle_rename(update, context, session, new_name):
     """Handle rename operation"""
+    chat_id = update.effective_chat.id
+    file_path = session['data'].get('file_path')
+    if not file_path or not os.path.exists(file_path):
+        update.message.reply_text("❌ File not found")
+        return
+    
+    # Clean name
+    new_name = new_name.replace('.pdf', '').strip()
+    if not new_name:
+        update.message.reply_text("❌ Invalid name")
+        return
+    
+    # Upload in the background
+    if submit_job(chat_id, context.bot, process_rename, session['tmpdir'], file_path, new_name):
+        clear_user_session(chat_id, keep_files=True)
+
+def process_rename(chat_id, bot, tmpdir, file_path, new_name):
+    """Process rename operation (runs on the job executor)"""
     try:
-        file_path = user_sessions[chat_id]['data'].get('file_path')
-        if not file_path or not os.path.exists(file_path):
-            update.message.reply_text("❌ File not found")
-            return STATE_WAITING
+        bot.send_message(chat_id, "🔄 Renaming...")
         
-        # Clean name
-        new_name = new_name.replace('.pdf', '').strip()
-        if not new_name:
-            update.message.reply_text("❌ Invalid name")
-            return STATE_WAITING
-        
-        update.message.reply_text("🔄 Renaming...")
-        
-        # Create output file
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
-            output_path = f.name
-        
-        # Copy file (simulated rename)
-        with open(file_path, 'rb') as src, open(output_path, 'wb') as dst:
-            dst.write(src.read())
-        
-        # Send result
-        with open(output_path, 'rb') as file:
-            context.bot.send_document(
+        # The new name only exists on the Telegram side, so send the
+        # uploaded file as-is under that name
+        with open(file_path, 'rb') as file:
+            bot.send_document(
                 chat_id=chat_id,
                 document=file,
                 caption=f"✅ Renamed to: {new_name}.pdf",
-                filename=f"{new_name}.pdf"
+                filename=f"{new_name}.pdf",
+                timeout=UPLOAD_TIMEOUT
             )
         
-        # Cleanup
-        os.unlink(file_path)
-        os.unlink(output_path)
-        
-        # Clear session
-        clear_user_session(chat_id)
-        update.message.reply_text("✅ Done! What next?", reply_markup=get_main_menu())
-        return STATE_WAITING
+        bot.send_message(chat_id, "✅ Done! What next?", reply_markup=MAIN_MENU)
     
     except Exception as e:
-        logger.error(f"Rename error: {e}")
-        update.message.reply_text(f"❌ Error: {str(e)[:100]}")
-        return STATE_WAITING
+        logger.error("Rename error: %s", e)
+        bot.send_message(chat_id, f"❌ Error: {str(e)[:100]}")
+    
+    finally:
+        temp_manager.discard(tmpdir)
 
-def process_watermark(chat_id, bot):
-    """Process watermark operation"""
+def process_watermark(chat_id, bot, tmpdir, data):
+    """Process watermark operation (runs on the job executor)"""
     try:
-        data = user_sessions[chat_id]['data']
         file_path = data.get('file_path')
         text = data.get('watermark_text')
         position = data.get('position')
@@ -479,37 +695,46 @@ def process_watermark(chat_id, bot):
         
         bot.send_message(chat_id, "🔄 Adding watermark...")
         
-        # Create output file
-        with tempfile.NamedTemporaryFile(suffix='_watermarked.pdf', delete=False) as f:
-            output_path = f.name
-        
-        # Add watermark
-        pdf_processor.add_watermark(file_path, output_path, text, position)
+        # Watermark into a fresh path in the session dir, as for merges
+        output_path = os.path.join(tmpdir, 'watermarked_output.pdf')
+        run_pdf_task(pdf_processor.add_watermark, file_path, output_path, text, position)
         
-        # Send result
-        with open(output_path, 'rb') as file:
+        with open_output(output_path) as output_file:
             bot.send_document(
                 chat_id=chat_id,
-                document=file,
+                document=output_file,
                 caption="✅ Watermark added!",
-                filename="watermarked.pdf"
+                filename="watermarked.pdf",
+                timeout=UPLOAD_TIMEOUT
             )
         
-        # Cleanup
-        os.unlink(file_path)
-        os.unlink(output_path)
-        
-        # Clear session
-        clear_user_session(chat_id)
-        bot.send_message(chat_id, "✅ Done! What next?", reply_markup=get_main_menu())
+        bot.send_message(chat_id, "✅ Done! What next?", reply_markup=MAIN_MENU)
     
     except Exception as e:
-        logger.error(f"Watermark error: {e}")
+        logger.error("Watermark error: %s", e)
         bot.send_message(chat_id, f"❌ Error: {str(e)[:100]}")
+    
+    finally:
+        temp_manager.discard(tmpdir)
+
+# Session state -> handler for uploaded documents and text replies
+DOCUMENT_HANDLERS = {
+    STATE_UPLOADING_MERGE: handle_merge_doc,
+    STATE_UPLOADING_RENAME: handle_rename_doc,
+    STATE_UPLOADING_WATERMARK: handle_watermark_doc,
+}
+
+TEXT_HANDLERS = {
+    STATE_WAITING_FILENAME: handle_rename,
+    STATE_WAITING_WATERMARK_TEXT: handle_watermark_text,
+}
+
+# Uploads handled as PDFs: PDF MIME type and a .pdf name
+PDF_DOCUMENT = Filters.document.pdf & Filters.document.file_extension('pdf')
 
 def error_handler(update, context):
     """Handle errors"""
-    logger.error(f"Update {update} caused error {context.error}")
+    logger.error("Update %s caused error %s", update, context.error)
     
     if update and update.effective_chat:
         context.bot.send_message(
@@ -528,57 +753,72 @@ def main():
     
     print(f"Starting PDF Utility Bot with token: {TOKEN[:10]}...")
     
-    # Create updater
-    updater = Updater(TOKEN, use_context=True)
-    dp = updater.dispatcher
-    
-    # Add conversation handler
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
-        states={
-            STATE_WAITING: [
-                CallbackQueryHandler(button_handler),
-                CommandHandler('help', help_command),
-                CommandHandler('cancel', cancel),
-                MessageHandler(Filters.document, handle_document),
-                MessageHandler(Filters.text, handle_text),
-            ],
-            STATE_UPLOADING_MERGE: [
-                MessageHandler(Filters.document, handle_document),
-                CommandHandler('cancel', cancel),
-            ],
-            STATE_UPLOADING_RENAME: [
-                MessageHandler(Filters.document, handle_document),
-                CommandHandler('cancel', cancel),
-            ],
-            STATE_UPLOADING_WATERMARK: [
-                MessageHandler(Filters.document, handle_document),
-                CommandHandler('cancel', cancel),
-            ],
-            STATE_WAITING_FILENAME: [
-                MessageHandler(Filters.text, handle_text),
-                CommandHandler('cancel', cancel),
-            ],
-            STATE_WAITING_WATERMARK_TEXT: [
-                MessageHandler(Filters.text, handle_text),
-                CommandHandler('cancel', cancel),
-            ],
-            STATE_WAITING_WATERMARK_POSITION: [
-                CallbackQueryHandler(button_handler),
-                CommandHandler('cancel', cancel),
-            ],
-        },
-        fallbacks=[CommandHandler('cancel', cancel)],
+    start_logging()
+    start_workers()
+    
+    # Create updater. Job and download threads call the Bot API
+    # concurrently with the dispatcher, so size the keep-alive pool for
+    # them as well (PTB's default only covers its own workers + 4). Connections are kept
+    # alive and reused; the timeouts apply to calls that don't set one.
+    updater = Updater(
+        TOKEN,
+        use_context=True,
+        request_kwargs={
+            'con_pool_size': JOB_WORKERS + DOWNLOAD_WORKERS + 8,
+            'connect_timeout': 10,
+            'read_timeout': 30
+        }
     )
+    dp = updater.dispatcher
     
-    dp.add_handler(conv_handler)
+    # Commands and buttons work in any state; messages are routed by the
+    # state stored in the user's session. Non-PDF uploads are turned away
+    # by the filters before any per-upload work.
+    dp.add_handler(CommandHandler('start', start))
+    dp.add_handler(CommandHandler('help', help_command))
+    dp.add_handler(CommandHandler('cancel', cancel))
+    dp.add_handler(CallbackQueryHandler(button_handler))
+    dp.add_handler(MessageHandler(PDF_DOCUMENT, handle_document))
+    dp.add_handler(MessageHandler(Filters.document, reject_document))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text))
     dp.add_error_handler(error_handler)
     
+    # Delete finished and abandoned temp files in the background
+    temp_manager.start_sweeper(max_age_minutes=TEMP_FILE_EXPIRY_MINUTES)
+    
+    # Everything allocated so far (modules, handlers, keyboards) lives for
+    # the whole run; move it out of the GC's reach so collections only
+    # scan per-update garbage
+    gc.collect()
+    gc.freeze()
+    
     # Start bot
     print("Bot is starting...")
-    updater.start_polling()
+    # Telegram pushes updates to us when we have a public URL; otherwise
+    # (local runs) fall back to long polling. Updates queued while the
+    # bot was down are dropped either way.
+    if WEBHOOK_BASE_URL:
+        updater.start_webhook(
+            listen='0.0.0.0',
+            port=PORT,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_BASE_URL}/{TOKEN}",
+            drop_pending_updates=True,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        updater.start_polling(
+            drop_pending_updates=True,
+            allowed_updates=ALLOWED_UPDATES
+        )
     print("Bot is running! Press Ctrl+C to stop.")
     updater.idle()
+    
+    # Let running jobs finish, then stop the workers
+    job_executor.shutdown(wait=True)
+    download_executor.shutdown(wait=True)
+    pdf_pool.shutdown(wait=True)
+    temp_manager.stop_sweeper()
 
 if __name__ == '__main__':
     main()
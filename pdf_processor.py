@@ -2,53 +2,115 @@
 PDF Processing Functions
 """
 
-from PyPDF2 import PdfMerger, PdfReader, PdfWriter
+import functools
+import shutil
+
+from pypdf import PdfReader, PdfWriter
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from io import BytesIO
 
+try:
+    import pikepdf
+except ImportError:
+    # Fall back to pypdf for merges and watermarks
+    pikepdf = None
+
+# Watermark position -> (x, y, rotation in degrees) on the A4 canvas
+POSITIONS = {
+    'center': (300, 400, 0),
+    'top': (300, 700, 0),
+    'bottom': (300, 100, 0),
+    'diagonal': (300, 300, 45),
+}
+
+# pypdf serializes in many small writes; coalesce them into large ones
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Distinct watermarks kept in memory (per worker process)
+WATERMARK_CACHE_SIZE = 128
+
+
+@functools.lru_cache(maxsize=WATERMARK_CACHE_SIZE)
+def _build_watermark_pdf(text, position, opacity):
+    """Render a one-page watermark PDF and return its bytes"""
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=A4)
+    can.setFillAlpha(opacity)
+    can.setFont("Helvetica-Bold", 36)
+    can.setFillColorRGB(0.5, 0.5, 0.5)
+    
+    # Position
+    x, y, rotation = POSITIONS.get(position, POSITIONS['center'])
+    if rotation:
+        can.rotate(rotation)
+    can.drawCentredString(x, y, text)
+    
+    can.save()
+    return packet.getvalue()
+
 
 class PDFProcessor:
     """Simple PDF processor"""
     
     def merge_pdfs(self, input_paths, output_path):
         """Merge multiple PDFs"""
-        merger = PdfMerger()
-        for pdf in input_paths:
-            merger.append(pdf)
-        merger.write(output_path)
-        merger.close()
+        if len(input_paths) == 1:
+            # Nothing to merge; copy the bytes instead of reparsing them
+            shutil.copyfile(input_paths[0], output_path)
+            return
+        
+        if pikepdf is not None:
+            # In-process qpdf: pages are copied by reference, not re-encoded.
+            # Sources must stay open until the output is saved.
+            sources = []
+            try:
+                with pikepdf.Pdf.new() as merged:
+                    for pdf in input_paths:
+                        sources.append(pikepdf.open(pdf))
+                        merged.pages.extend(sources[-1].pages)
+                    merged.save(output_path, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+            finally:
+                for source in sources:
+                    source.close()
+            return
+        
+        # One PdfReader per input, appended whole (no per-page reparse)
+        writer = PdfWriter()
+        try:
+            for pdf in input_paths:
+                writer.append(PdfReader(pdf))
+            with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as output_file:
+                writer.write(output_file)
+        finally:
+            writer.close()
     
     def add_watermark(self, input_path, output_path, text, position='center', opacity=0.3):
         """Add watermark to PDF"""
-        # Create watermark
-        packet = BytesIO()
-        can = canvas.Canvas(packet, pagesize=A4)
-        can.setFillAlpha(opacity)
-        can.setFont("Helvetica-Bold", 36)
-        can.setFillColorRGB(0.5, 0.5, 0.5)
-        
-        # Position
-        if position == 'center':
-            can.drawCentredString(300, 400, text)
-        elif position == 'top':
-            can.drawCentredString(300, 700, text)
-        elif position == 'bottom':
-            can.drawCentredString(300, 100, text)
-        elif position == 'diagonal':
-            can.rotate(45)
-            can.drawCentredString(300, 300, text)
+        # Create watermark (reused when the same one was rendered before)
+        packet = BytesIO(_build_watermark_pdf(text, position, round(opacity, 2)))
         
-        can.save()
-        packet.seek(0)
+        if pikepdf is not None:
+            # qpdf-backed overlay: the watermark becomes one shared Form
+            # XObject instead of a content-stream rewrite per page. The
+            # A4 rect keeps it unscaled, exactly where merge_page puts it.
+            with pikepdf.open(packet) as watermark, pikepdf.open(input_path) as pdf:
+                overlay = watermark.pages[0]
+                rect = pikepdf.Rectangle(0, 0, *A4)
+                for page in pdf.pages:
+                    page.add_overlay(overlay, rect)
+                pdf.save(output_path)
+            return
         
-        # Apply watermark
+        # Apply watermark (parsed once, merged onto every page)
+        watermark_page = PdfReader(packet).pages[0]
         reader = PdfReader(input_path)
         writer = PdfWriter()
         
         for page in reader.pages:
-            page.merge_page(PdfReader(packet).pages[0])
-            writer.add_page(page)
+            page.merge_page(watermark_page)
+            # merge_page leaves the combined content stream uncompressed
+            writer.add_page(page).compress_content_streams()
         
-        with open(output_path, 'wb') as output_file:
+        with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as output_file:
             writer.write(output_file)
@@ -16,13 +16,6 @@ mkdir -p temp
 # Set proper permissions
 chmod -R 755 temp/
 
-# Run the application
-echo "Starting Gunicorn server..."
-exec gunicorn bot:app \
-    --bind 0.0.0.0:$PORT \
-    --workers 1 \
-    --threads 8 \
-    --timeout 120 \
-    --access-logfile logs/access.log \
-    --error-logfile logs/error.log \
-    --log-level info
+# Run the application (webhook mode when RENDER_EXTERNAL_URL is set)
+echo "Starting bot..."
+exec python bot.py
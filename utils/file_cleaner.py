@@ -3,33 +3,174 @@ Temporary file management
 """
 
 import os
+import queue
+import shutil
 import tempfile
 import threading
 import time
-from datetime import datetime, timedelta
+import uuid
+from contextlib import suppress
+
+
+# RAM-backed tmpfs, preferred for PDF scratch files when present
+SHM_DIR = '/dev/shm'
+# Minimum free space on the tmpfs before we trust it with PDFs
+SHM_MIN_FREE_BYTES = 128 * 1024 * 1024
+
+# An idle stale scan doubles the wait before the next one, up to this
+# multiple of the base interval
+SWEEP_BACKOFF_MAX = 16
+
+# Session directories are named with this prefix. Their owner discards
+# them explicitly, so the stale scan leaves them alone.
+SESSION_PREFIX = 'session_'
+
+# Queued by stop_sweeper() to end the sweeper loop
+_STOP = object()
+
+
+def _pick_base_dir():
+    """
+    Return PDF_BOT_TMPDIR if set, else /dev/shm if it is usable, else None
+    (system temp dir)
+    """
+    override = os.getenv('PDF_BOT_TMPDIR')
+    if override:
+        return override
+    
+    if not (os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK)):
+        return None
+    
+    # tmpfs pages count against RAM; a tiny /dev/shm would OOM the bot
+    if shutil.disk_usage(SHM_DIR).free < SHM_MIN_FREE_BYTES:
+        return None
+    
+    return SHM_DIR
+
+
+def _remove(path, is_dir=None):
+    """
+    Delete a temp file or a whole session directory, ignoring errors
+    """
+    if is_dir is None:
+        is_dir = os.path.isdir(path)
+    
+    if is_dir:
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    
+    with suppress(OSError):
+        os.unlink(path)
 
 
 class TempFileManager:
     """Manage temporary files"""
     
     def __init__(self):
-        self.temp_dir = tempfile.mkdtemp(prefix='pdf_bot_')
+        self.temp_dir = tempfile.mkdtemp(prefix='pdf_bot_', dir=_pick_base_dir())
+        self._discarded = queue.SimpleQueue()
+        self._sweeper = None
         print(f"Temp directory: {self.temp_dir}")
     
+    def create_temp_file(self, suffix='.pdf', delete=False, dir=None):
+        """
+        Open a new temp file inside the managed directory (or a session
+        directory within it)
+        """
+        return tempfile.NamedTemporaryFile(suffix=suffix, dir=dir or self.temp_dir, delete=delete)
+    
+    def create_session_dir(self):
+        """
+        Create a directory for one session's files, removed as a whole
+        with discard()
+        """
+        return tempfile.mkdtemp(prefix=SESSION_PREFIX, dir=self.temp_dir)
+    
+    def link_copy(self, path, suffix='.pdf', dir=None):
+        """
+        Give a temp file a second name (hard link, no data copied)
+        """
+        new_path = os.path.join(dir or self.temp_dir, f"{uuid.uuid4().hex}{suffix}")
+        os.link(path, new_path)
+        return new_path
+    
+    def discard(self, path):
+        """
+        Queue a file or session directory for deletion by the sweeper thread
+        """
+        self._discarded.put(path)
+    
+    def start_sweeper(self, max_age_minutes=30, interval_seconds=60):
+        """
+        Start the background thread that deletes discarded and stale files
+        """
+        self._sweeper = threading.Thread(
+            target=self._sweep,
+            args=(max_age_minutes, interval_seconds),
+            name='temp_sweeper',
+            daemon=True
+        )
+        self._sweeper.start()
+    
+    def stop_sweeper(self):
+        """
+        Stop the sweeper after it has handled everything already
+        discarded, then remove the whole temp directory
+        """
+        if self._sweeper is not None:
+            self._discarded.put(_STOP)
+            self._sweeper.join()
+            self._sweeper = None
+        
+        # On tmpfs, leftovers would hold RAM until the next reboot
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _sweep(self, max_age_minutes, interval_seconds):
+        """
+        Sweeper loop: delete discarded files as they arrive and scan for
+        stale ones, less often while the scans find nothing
+        """
+        interval = interval_seconds
+        next_scan = time.monotonic() + interval
+        while True:
+            try:
+                path = self._discarded.get(timeout=max(0, next_scan - time.monotonic()))
+            except queue.Empty:
+                pass
+            else:
+                if path is _STOP:
+                    return
+                _remove(path)
+            
+            if time.monotonic() >= next_scan:
+                if self.cleanup_old_files(max_age_minutes):
+                    interval = max(interval // 2, interval_seconds)
+                else:
+                    interval = min(interval * 2, interval_seconds * SWEEP_BACKOFF_MAX)
+                next_scan = time.monotonic() + interval
+    
     def cleanup_old_files(self, max_age_minutes=30):
         """
-        Clean up old files
+        Clean up old files; returns how many entries were removed.
+        Session directories are skipped: a live session may keep a file
+        untouched for longer than max_age_minutes.
         """
+        removed = 0
         try:
-            cutoff_time = datetime.now() - timedelta(minutes=max_age_minutes)
+            cutoff = time.time() - max_age_minutes * 60
             
-            for filename in os.listdir(self.temp_dir):
-                file_path = os.path.join(self.temp_dir, filename)
-                try:
-                    file_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-                    if file_time < cutoff_time:
-                        os.unlink(file_path)
-                except:
-                    pass
+            # scandir hands back the entry type with the name, so only the
+            # mtime needs a stat call
+            with os.scandir(self.temp_dir) as entries:
+                for entry in entries:
+                    if entry.name.startswith(SESSION_PREFIX):
+                        continue
+                    # Entries deleted by someone else since the scan started
+                    # are skipped
+                    with suppress(OSError):
+                        if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                            _remove(entry.path, entry.is_dir(follow_symlinks=False))
+                            removed += 1
         except Exception as e:
             print(f"Cleanup error: {e}")
+        return removed